@@ -1,10 +1,18 @@
 import cv2
+import numpy as np
 import threading
 import os
-from queue import Queue, Empty
-from lib.ringbuffer import RingBuffer
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from lib.ringbuffer import RingBuffer, SPSCRing
+from lib.encoder import VideoEncoder
+from lib.threads import pin_current_thread, raise_current_thread_priority
 from sys import platform
 
+logger = logging.getLogger(__name__)
+
 class Clipper:
     """
     A class for capturing short clips from a video stream and saving them as an mp4 file
@@ -13,8 +21,11 @@ class Clipper:
     Use `clip` to save a clip to an mp4 file.
     When the clipping is no longer needed, call `stop` to release resources.
     The class will release the cv2.VideoCapture object passed into the constructor
+
+    Frames are buffered as YUV I420 (1.5 bytes per pixel instead of 3 for BGR) to halve the memory the
+    buffer needs, which requires the capture's frame width and height to be even.
     """
-    def __init__(self, video_capture, buffer_size=240*60, estimated_fps=30):
+    def __init__(self, video_capture, buffer_size=240*60, estimated_fps=30, capture_core=None, encoder_core=None):
         """
         Initializes a Clipper instance.
 
@@ -23,20 +34,53 @@ class Clipper:
         video_capture : cv2.VideoCapture
             The video capture object
         buffer_size : int, optional
-            Max number of frames Clipper can hold. Defaults to 240fps * 60secs.
+            Max number of frames Clipper can hold. Defaults to 240fps * 60secs. Rounded up to a power of
+            two (the default becomes 16384 frames). The whole buffer is allocated and filled with black
+            frames up front, 1.5 bytes per pixel per frame, so e.g. 16384 frames of 1080p take ~51GB.
         estimated_fps : int, optional
             The estimated frames per second. Defaults to 30
+        capture_core : int, optional
+            CPU core to pin the thread reading from video_capture to (Linux only). Defaults to no pinning
+        encoder_core : int, optional
+            CPU core to pin the encoder thread to (Linux only). Should differ from capture_core so
+            encoding can't preempt capture. Defaults to no pinning
         """
         self._video_capture = video_capture
-        self._msg_queue = Queue()
+        # Keep the driver from queueing up frames so the buffer always holds the newest frames. Not every
+        # backend supports this, in which case it's a no-op
+        video_capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        # Polled by the buffer thread every frame. Checking the event is a plain attribute read, no lock
+        self._msg_queue = deque()
+        self._msg_event = threading.Event()
+        # The capture thread waits on the camera and decodes frames, then hands them to the buffer thread
+        # which converts and stores them, so waiting on the driver overlaps with copying frames
+        self._captured_frames = SPSCRing(1)
+        self._wake = threading.Event()
+        self._capturing = True
+        self._capture_thread = None
         self._thread = None
-        self._estimated_fps = estimated_fps
+        # Clips are encoded on their own thread so saving one doesn't stall frame capture
+        self._encoder_thread = ThreadPoolExecutor(max_workers=1, initializer=pin_current_thread, initargs=(encoder_core,))
+        # The worker thread is only created on the first submit and inherits the priority of the thread
+        # that submits it. Start it now so it doesn't inherit the raised priority of the buffer thread
+        self._encoder_thread.submit(lambda: None)
+        self._capture_core = capture_core
 
-        # TODO: initialize with black frames. Using None for now because I'm lazy
-        self._frame_buffer = RingBuffer(buffer_size, None)
+        width = int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        # Encoder setup only depends on the capture so it's done once instead of on every clip
+        self._encoder = VideoEncoder(estimated_fps, (width, height))
+        # I420 stores the full size Y plane followed by the quarter size U and V planes
+        yuv_shape = (height * 3 // 2, width)
+        black = cv2.cvtColor(np.zeros((height, width, 3), dtype=np.uint8), cv2.COLOR_BGR2YUV_I420)
+        self._frame_buffer = RingBuffer(buffer_size, yuv_shape, default=black)
+        self._yuv_frame = black.copy()
+        self._frame_shape_logged = False
         self._ms_per_frame = (1 / estimated_fps) * 1000
 
-        t = threading.Thread(target=self._start)
+        self._capture_thread = threading.Thread(target=self._capture_loop)
+        self._capture_thread.start()
+        t = threading.Thread(target=self._buffer_loop)
         self._thread = t
         t.start()
 
@@ -59,7 +103,7 @@ class Clipper:
         """
         if not self.is_active():
             raise Exception("Clipper is not active")
-        self._msg_queue.put(_ClipMessage(length_ms, file_name))
+        self._send(_ClipMessage(length_ms, file_name))
 
     def stop(self):
         """
@@ -72,8 +116,11 @@ class Clipper:
         if not self.is_active():
             return
 
-        self._msg_queue.put(_StopMessage())
+        self._send(_StopMessage())
         self._thread.join()
+        self._capturing = False
+        self._capture_thread.join()
+        self._encoder_thread.shutdown(wait=True)
         self._video_capture.release()
 
     def is_active(self):
@@ -87,49 +134,125 @@ class Clipper:
         """
         return self._thread is not None
 
-    def _start(self):
+    def _capture_loop(self):
         """
-        The main function for the worker thread.
-        Continuously captures frames, processes messages, and saves clips as requested.
+        The main function for the capture thread.
+        Continuously grabs and decodes frames from the video capture and hands them to the buffer thread.
+
+        grab and retrieve stay on this thread since cv2.VideoCapture isn't safe to use from multiple
+        threads. Both release the GIL while waiting on the driver and decoding.
         """
-        while True:
-            ret, frame = self._video_capture.read()
+        pin_current_thread(self._capture_core)
+        raise_current_thread_priority()
+
+        failed_frames = 0
+        last_failure_log = 0
+        while self._capturing:
+            ret = self._video_capture.grab()
+            if ret and self._captured_frames.full():
+                # The buffer thread is still busy with the previous frame. Drop this one before decoding
+                # it rather than letting the capture fall behind the camera
+                continue
+            if ret:
+                ret, frame = self._video_capture.retrieve()
             if not ret:
-                # Not too sure what to do in this case other than log and continue
-                print("Unable to capture video frame")
+                # Not too sure what to do in this case other than log and continue. Failures tend to
+                # come in bursts so they're counted and logged at most once a second
+                failed_frames += 1
+                now = time.monotonic()
+                if now - last_failure_log >= 1:
+                    logger.warning("Unable to capture %d video frame(s)", failed_frames)
+                    failed_frames = 0
+                    last_failure_log = now
+                continue
+
+            if failed_frames:
+                # Report failures that were held back by the rate limit now that capture has recovered
+                logger.warning("Unable to capture %d video frame(s)", failed_frames)
+                failed_frames = 0
+
+            # Only this thread pushes so the space checked for above is still free
+            self._captured_frames.push(frame)
+            self._wake.set()
+
+        if failed_frames:
+            logger.warning("Unable to capture %d video frame(s)", failed_frames)
+
+    def _buffer_loop(self):
+        """
+        The main function for the buffer thread.
+        Continuously stores captured frames, processes messages, and saves clips as requested.
+        """
+        raise_current_thread_priority()
+
+        while True:
+            self._wake.wait()
+            # Clear before popping so a frame pushed while this one is stored wakes the thread again
+            self._wake.clear()
+
+            frame = self._captured_frames.pop()
+            if frame is not None:
+                # cvtColor only writes into dst if the shapes match, otherwise it returns a new array
+                yuv = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420, dst=self._yuv_frame)
+                if yuv.shape == self._yuv_frame.shape:
+                    self._frame_buffer.add(yuv)
+                elif not self._frame_shape_logged:
+                    logger.error("Dropping captured frames of size %dx%d, expected %dx%d",
+                                 frame.shape[1], frame.shape[0], self._yuv_frame.shape[1], self._yuv_frame.shape[0] * 2 // 3)
+                    self._frame_shape_logged = True
+
+            if not self._msg_event.is_set():
                 continue
 
-            self._frame_buffer.add(frame)
-            try:
-                msg = self._msg_queue.get(False)
+            # Clear before draining so a message sent while draining sets the event again
+            self._msg_event.clear()
+            while self._msg_queue:
+                msg = self._msg_queue.popleft()
                 if msg.kind == _StopMessage.kind:
-                    break
+                    return
 
                 if msg.kind == _ClipMessage.kind:
-                    self._save_clip(msg.length_ms, msg.file_name)
+                    self._queue_clip(msg.length_ms, msg.file_name)
                     continue
 
                 raise Exception("Unknown message type")
-            except Empty:
-                continue
 
-    def _save_clip(self, length_ms, file):
+    def _send(self, msg):
         """
-        Private method for saving a video clip to the specified file.
+        Private method for sending a message to the buffer thread.
         """
-        num_frames = min(round(length_ms / self._ms_per_frame), len(self._frame_buffer))
-        start_frame = len(self._frame_buffer) - num_frames
+        self._msg_queue.append(msg)
+        self._msg_event.set()
+        self._wake.set()
 
-        width = self._video_capture.get(cv2.CAP_PROP_FRAME_WIDTH)
-        height = self._video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT)
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = cv2.VideoWriter(file, fourcc, self._estimated_fps, (int(width), int(height)))
+    def _queue_clip(self, length_ms, file):
+        """
+        Private method for snapshotting the most recent frames and handing them to the encoder thread.
 
-        for i in range(start_frame, len(self._frame_buffer)):
-            out.write(self._frame_buffer.get(i))
+        The frames are copied so the buffer thread can keep overwriting the ring buffer while the clip
+        is being saved.
+        """
+        buffer_len = len(self._frame_buffer)
+        num_frames = min(round(length_ms / self._ms_per_frame), buffer_len)
+        start_frame = buffer_len - num_frames
+
+        # A single contiguous copy of both halves of the range
+        frames = np.concatenate(self._frame_buffer.get_range(start_frame, num_frames))
+        self._encoder_thread.submit(self._save_clip, frames, file)
+
+    def _save_clip(self, frames, file):
+        """
+        Private method for saving a video clip to the specified file. Runs on the encoder thread.
+
+        Nothing waits on the encoder thread's futures so failures are logged here instead of being lost.
+        """
+        try:
+            self._encoder.encode(frames, file)
+        except Exception:
+            logger.exception("Unable to save clip to %s", file)
+            return
 
-        out.release()
-        print("Saved clip to", file)
+        logger.info("Saved clip to %s", file)
         if platform == "darwin":
             os.system(f"open {file}")
 
@@ -0,0 +1,144 @@
+import cv2
+import numpy as np
+import shutil
+import subprocess
+import logging
+from sys import platform
+
+logger = logging.getLogger(__name__)
+
+class VideoEncoder:
+    """
+    A class for encoding frames to mp4 files
+
+    When an ffmpeg executable is on the PATH the frames are piped to it as raw video in one stream, which
+    lets ffmpeg encode with multiple threads: VideoToolbox on macOS, and libx264 everywhere else.
+    Otherwise frames are written one at a time through cv2.VideoWriter, preferring a hardware H.264
+    encoder: VideoToolbox (through AVFoundation) on macOS, and whatever accelerated encoder OpenCV's
+    FFmpeg backend can find (NVENC, QuickSync, VAAPI, ...) everywhere else. Falls back to OpenCV's
+    software MPEG-4 encoder when no hardware encoder can be opened. If ffmpeg fails the clip is written
+    with cv2.VideoWriter instead. ffmpeg is only disabled for later clips when cv2.VideoWriter then
+    succeeds, meaning the problem was ffmpeg itself (e.g. built without the H.264 encoder) rather than the
+    destination file.
+
+    Everything that only depends on the fps and frame size is worked out once in the constructor. Use
+    `encode` to write a file. Only call `encode` from one thread at a time.
+    """
+    def __init__(self, fps, frame_size):
+        """
+        Initializes a VideoEncoder instance
+
+        Parameters
+        ----------
+        fps : int
+            Frames per second of the output videos
+        frame_size : tuple
+            (width, height) of the frames that will be encoded
+        """
+        self._fps = fps
+        self._frame_size = frame_size
+
+        ffmpeg = shutil.which("ffmpeg")
+        self._ffmpeg_command = None if ffmpeg is None else _ffmpeg_command(ffmpeg, fps, frame_size)
+
+        self._fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        self._hardware_fourcc = cv2.VideoWriter_fourcc(*'avc1')
+        # Whether a hardware writer is available can only be found out by opening a file, so it's tried
+        # on the first clip and not again once the software writer opens a file it couldn't
+        self._use_hardware_writer = True
+        width, height = frame_size
+        self._bgr_frame = np.empty((height, width, 3), dtype=np.uint8)
+
+    def encode(self, frames, file_name):
+        """
+        Encode frames to an mp4 file
+
+        Parameters
+        ----------
+        frames : numpy.ndarray
+            Array of YUV I420 frames to encode
+        file_name : str
+            The name of the mp4 file to write
+
+        Raises
+        ------
+        Exception
+            If the file couldn't be written
+        """
+        if self._ffmpeg_command is not None:
+            returncode = self._encode_ffmpeg(frames, file_name)
+            if returncode == 0:
+                return
+
+            logger.warning("ffmpeg exited with code %d, falling back to OpenCV's encoder", returncode)
+            # Raises if the file can't be written either, in which case ffmpeg is kept for later clips
+            self._encode_opencv(frames, file_name)
+            logger.warning("OpenCV's encoder wrote %s, not using ffmpeg for later clips", file_name)
+            self._ffmpeg_command = None
+            return
+
+        self._encode_opencv(frames, file_name)
+
+    def _encode_ffmpeg(self, frames, file_name):
+        """
+        Pipe frames to ffmpeg and return its exit code.
+        """
+        ffmpeg = subprocess.Popen(self._ffmpeg_command + [file_name],
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.DEVNULL
+                              )
+        # I420 is ffmpeg's yuv420p so the frames are piped as is, without a copy or conversion.
+        # communicate ignores the broken pipe if ffmpeg exits early, the exit code says what went wrong
+        ffmpeg.communicate(np.ascontiguousarray(frames).data)
+        return ffmpeg.returncode
+
+    def _encode_opencv(self, frames, file_name):
+        """
+        Write frames one at a time with a cv2.VideoWriter. Raises if no writer can be opened.
+        """
+        writer = None
+        if self._use_hardware_writer:
+            writer = self._open_hardware_writer(file_name)
+        if writer is None:
+            writer = cv2.VideoWriter(file_name, self._fourcc, self._fps, self._frame_size)
+            if not writer.isOpened():
+                raise Exception(f"Unable to open a video writer for {file_name}")
+            # The file could be opened so it's the hardware encoder that's missing, not the destination
+            self._use_hardware_writer = False
+
+        for frame in frames:
+            cv2.cvtColor(frame, cv2.COLOR_YUV2BGR_I420, dst=self._bgr_frame)
+            writer.write(self._bgr_frame)
+        writer.release()
+
+    def _open_hardware_writer(self, file_name):
+        """
+        Open a cv2.VideoWriter backed by a hardware H.264 encoder. Returns None if one isn't available.
+        """
+        if platform == "darwin":
+            # AVFoundation encodes H.264 with VideoToolbox
+            writer = cv2.VideoWriter(file_name, cv2.CAP_AVFOUNDATION, self._hardware_fourcc, self._fps, self._frame_size)
+        else:
+            params = [cv2.VIDEOWRITER_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+            writer = cv2.VideoWriter(file_name, cv2.CAP_FFMPEG, self._hardware_fourcc, self._fps, self._frame_size, params)
+
+        if not writer.isOpened():
+            writer.release()
+            return None
+        return writer
+
+def _ffmpeg_command(ffmpeg, fps, frame_size):
+    """
+    Build the ffmpeg command line, minus the output file name, for encoding raw I420 frames from stdin
+    to an H.264 mp4 file.
+    """
+    width, height = frame_size
+    if platform == "darwin":
+        codec = ["-c:v", "h264_videotoolbox"]
+    else:
+        # Capped so encoding doesn't crowd out the capture and audio threads
+        codec = ["-c:v", "libx264", "-preset", "ultrafast", "-threads", "4"]
+
+    return [ffmpeg, "-loglevel", "error", "-y",
+            "-f", "rawvideo", "-pix_fmt", "yuv420p", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+            *codec, "-pix_fmt", "yuv420p"]
@@ -1,27 +1,38 @@
 import pyaudio
-import threading
-from queue import Queue, Empty
 import numpy as np
 import time
+import logging
+from numba import njit
+from lib.threads import pin_current_thread
+from lib.ringbuffer import SPSCRing
 
-FRAMES_PER_BUFFER=1024
+FRAMES_PER_BUFFER=128
+# Loudness doesn't need the full audible bandwidth so half of the common 44.1kHz is plenty
+SAMPLE_RATE=22050
+# Common sampling frequency that seems to work for our application: https://en.wikipedia.org/wiki/44,100_Hz
+# Used when the device doesn't support SAMPLE_RATE
+FALLBACK_SAMPLE_RATE=44100
+
+logger = logging.getLogger(__name__)
 
 class LoudnessDetector:
     """
     A class for detecting loud sounds
 
     The class detects loud sounds using the default audio device for the system. Audio is processed in
-    buffers of 1024 frames. Loudness is determined by comparing the mean value of the amplitudes for
-    the buffer to a threshold that is passed in the constructor. When a loud sound is detected a message
-    sent to the out_queue Queue of the class containing the mean amplitude value for the buffer that
-    triggered the threshold.
+    buffers (128 frames by default) on PortAudio's audio thread as they are captured. Loudness is
+    determined by comparing the mean value of the amplitudes for the buffer to a threshold that is passed
+    in the constructor. When a loud sound is detected a message sent to the out_queue SPSCRing of the class
+    containing the mean amplitude value for the buffer that triggered the threshold.
+
+    Audio is sampled at 22.05kHz, or 44.1kHz on devices that don't support it.
 
     Attributes
     ----------
-    out_queue : queue.Queue
-        Queue that is written to when a loud sound is detected
+    out_queue : SPSCRing
+        Lock-free queue that is written to when a loud sound is detected. Only read it from one thread
     """
-    def __init__(self, threshold, buffer_ms=0):
+    def __init__(self, threshold, buffer_ms=0, frames_per_buffer=FRAMES_PER_BUFFER, core=None):
         """
         Initializes a LoudnessDetector instance
 
@@ -31,25 +42,38 @@ class LoudnessDetector:
             Threshold to determine if a buffer was "loud". Compared to the mean value of amplitudes for a buffer.
         buffer_ms : int
             Delay to add after detecting a loud sound before listening for loud sounds again. Used to avoid firing off multiple events for the same sound.
+        frames_per_buffer : int, optional
+            Number of frames processed at a time. Smaller buffers detect sounds sooner. Defaults to 128 (~6ms at 22.05kHz)
+        core : int, optional
+            CPU core to pin the audio callback thread to (Linux only). Defaults to no pinning
 
         """
         self._p = pyaudio.PyAudio()
+        rate = SAMPLE_RATE
+        if not _supports_format(self._p, SAMPLE_RATE, pyaudio.paInt16):
+            rate = FALLBACK_SAMPLE_RATE
+
+        # Comparing the sum of amplitudes against threshold * frames avoids dividing for the mean
+        self._threshold_sum = threshold * frames_per_buffer
+        self._buffer_ms = buffer_ms
+        self._ignore_until = 0
+        self._core = core
+        self._pinned = False
+        # Every buffer is copied into the same memory so the view never needs to be recreated
+        self._scratch = bytearray(frames_per_buffer * 2)
+        self._view = np.frombuffer(self._scratch, dtype=np.int16)
+        self._scratch_bytes = memoryview(self._scratch)
+        # Compile the loudness kernel now so the first buffer doesn't pay for it
+        _abs_sum(self._view)
+        self.out_queue = SPSCRing(16)
+
         self._stream = self._p.open(format=pyaudio.paInt16,
                         channels=1,
-                        # Common sampling frequency that seems to work for our application: https://en.wikipedia.org/wiki/44,100_Hz
-                        rate=44100,
+                        rate=rate,
                         input=True,
-                        frames_per_buffer=FRAMES_PER_BUFFER
+                        frames_per_buffer=frames_per_buffer,
+                        stream_callback=self._cb
                     )
-
-        self._threshold = threshold
-        self._buffer_ms = buffer_ms
-        self._in_queue = Queue()
-        self.out_queue = Queue()
-
-        t = threading.Thread(target=self._start)
-        self._thread = t
-        self._thread.start()
         self._active = True
 
     def stop(self):
@@ -64,29 +88,63 @@ class LoudnessDetector:
             return
 
         self._active = False
-        self._in_queue.put("stop")
-        self._thread.join()
         self._stream.stop_stream()
         self._stream.close()
         self._p.terminate()
 
+    def _cb(self, in_data, frame_count, time_info, status):
+        """
+        The stream callback, called by PortAudio on its audio thread for every captured buffer.
 
-    def _start(self):
-        while True:
-            data = self._stream.read(FRAMES_PER_BUFFER, exception_on_overflow=False)
-            audio_array = np.frombuffer(data, dtype=np.int16)
-            mean = np.mean(np.abs(audio_array))
-
-            if mean > self._threshold:
-                print("Detected loud sound")
-                self.out_queue.put(mean, False)
-                time.sleep(self._buffer_ms / 1000)
-
-            try:
-                msg = self._in_queue.get(False)
-                if msg == "stop":
-                    break
-
-                raise Exception("Unknown message type")
-            except Empty:
-                continue
\ No newline at end of file
+        This must never block so instead of sleeping for buffer_ms after a loud sound, buffers are
+        ignored until buffer_ms has passed.
+        """
+        if not self._pinned:
+            # PortAudio already runs the callback thread at an elevated priority so only the core is set
+            pin_current_thread(self._core)
+            self._pinned = True
+
+        if time.monotonic() < self._ignore_until:
+            return (None, pyaudio.paContinue)
+
+        if len(in_data) == len(self._scratch):
+            self._scratch_bytes[:] = in_data
+            total = _abs_sum(self._view)
+        else:
+            # PortAudio doesn't promise every buffer is frames_per_buffer long. The scratch can't be
+            # resized while the view exists, so only what fits is measured and scaled to a full buffer
+            n = min(len(in_data), len(self._scratch))
+            self._scratch_bytes[:n] = memoryview(in_data)[:n]
+            samples = n // self._view.itemsize
+            if samples == 0:
+                return (None, pyaudio.paContinue)
+            total = _abs_sum(self._view[:samples]) * len(self._view) // samples
+
+        if total > self._threshold_sum:
+            logger.info("Detected loud sound")
+            self.out_queue.push(total / len(self._view))
+            self._ignore_until = time.monotonic() + self._buffer_ms / 1000
+
+        return (None, pyaudio.paContinue)
+
+def _supports_format(p, rate, audio_format):
+    """
+    Check if the default input device can capture mono audio in audio_format at rate
+    """
+    device = p.get_default_input_device_info()["index"]
+    try:
+        return p.is_format_supported(rate, input_device=device, input_channels=1, input_format=audio_format)
+    except ValueError:
+        return False
+
+@njit(cache=True)
+def _abs_sum(x):
+    """
+    Sum of the absolute values of an int16 array in a single pass without any temporary arrays
+    """
+    total = 0
+    for i in range(x.shape[0]):
+        # Widen before negating so abs(-32768) doesn't overflow
+        v = np.int32(x[i])
+        total += v if v >= 0 else -v
+    return total
\ No newline at end of file
@@ -1,38 +1,52 @@
+import numpy as np
+
 class RingBuffer:
     """
-    A datastructure that acts as a single fixed size circular buffer
+    A datastructure that acts as a single fixed size circular buffer of frames
 
-    This implementation assumes the buffer is always full and thus needs to be initialized with a
-    default value. Use `add` to overwrite the oldest value, and `get` to retrieve the value at a
-    particular index. The 0th index is the oldest value and nth - 1 index is the newest value.
+    The frames are stored in a single preallocated numpy array so adding a frame copies it into memory
+    that is reused every time the buffer wraps around. This implementation assumes the buffer is always
+    full and starts out filled with a default frame, zeros unless one is given. Use `add` to overwrite
+    the oldest frame, `get` to retrieve the frame at a particular index, and `get_range` to retrieve a
+    run of frames without copying. The 0th index is the oldest value and nth - 1 index is the newest value.
     """
-    def __init__(self, size, default):
+    def __init__(self, size, frame_shape, dtype=np.uint8, default=None):
         """
         Initializes a new RingBuffer
 
         Parameters
         ----------
-        size : type
-            Number of items the buffer can hold
-        default
-            Default value for buffer items
+        size : int
+            Number of frames the buffer can hold. Rounded up to a power of two so indexes can be masked
+            instead of using modulo
+        frame_shape : tuple
+            Shape of a single frame, e.g. (height, width, 3)
+        dtype : numpy.dtype, optional
+            Data type of the frames. Defaults to np.uint8
+        default : numpy.ndarray, optional
+            Frame every slot of the buffer starts out as. Defaults to all zeros
         """
-        self.buffer = [default] * size
-        self.endIndex = len(self.buffer) - 1
+        size = 1 << max(size - 1, 0).bit_length()
+        self.size = size
+        self._mask = size - 1
+        self.buffer = np.zeros((size,) + tuple(frame_shape), dtype=dtype)
+        if default is not None:
+            self.buffer[:] = default
+        self.endIndex = size - 1
 
     def add(self, item):
         """
-        Add an item to the ring buffer
+        Add a frame to the ring buffer
 
-        Overwrites the oldex item in the array (index 0)
+        Overwrites the oldest frame in the array (index 0) by copying item into the buffer's memory
 
         Parameters
         ----------
-        item
-            Item to add to the buffer
+        item : numpy.ndarray
+            Frame to add to the buffer. Must match the frame shape the buffer was created with
         """
-        self.endIndex  = (self.endIndex + 1) % len(self.buffer)
-        self.buffer[self.endIndex] = item
+        self.endIndex = (self.endIndex + 1) & self._mask
+        np.copyto(self.buffer[self.endIndex], item)
 
     def get(self, index):
         """
@@ -47,16 +61,126 @@ class RingBuffer:
 
         Returns
         -------
-        any
-            Item at the specified index in the array
+        numpy.ndarray
+            View of the frame at the specified index in the array
         """
-        if index < 0 or index >= len(self.buffer):
+        if index < 0 or index >= self.size:
             raise IndexError("Out of range")
 
         # Since it's a full ring buffer, the start index is right after the end
-        start_index = (self.endIndex + 1) % len(self.buffer)
-        actual_index = (start_index + index) % len(self.buffer)
+        start_index = (self.endIndex + 1) & self._mask
+        actual_index = (start_index + index) & self._mask
         return self.buffer[actual_index]
 
+    def get_range(self, start, n):
+        """
+        Get n consecutive frames starting at a particular index
+
+        The frames may wrap around the end of the underlying array so they are returned as two
+        contiguous views. The frames in the first view come before the frames in the second view. When
+        the range doesn't wrap the second view is empty. The views share memory with the buffer so copy
+        them if they need to outlive subsequent calls to `add`.
+
+        Parameters
+        ----------
+        start : int
+            Index of the first frame to retrieve, 0 being the oldest frame
+        n : int
+            Number of frames to retrieve
+
+        Returns
+        -------
+        tuple of numpy.ndarray
+            The two views (seg_a, seg_b) that together make up the requested frames
+        """
+        if start < 0 or n < 0 or start + n > self.size:
+            raise IndexError("Out of range")
+
+        a = (self.endIndex + 1 + start) & self._mask
+        first = min(n, self.size - a)
+        return self.buffer[a:a + first], self.buffer[:n - first]
+
     def __len__(self):
-        return len(self.buffer)
\ No newline at end of file
+        return self.size
+
+class SPSCRing:
+    """
+    A bounded lock-free queue for handing items from exactly one producer thread to exactly one consumer
+    thread
+
+    Neither side takes a lock: the producer is the only writer of the tail index and the consumer is the
+    only writer of the head index, and each side only publishes its index after it's done with the slot.
+    This relies on the GIL making individual list item and attribute stores atomic. Use `push` and `full`
+    from the producer thread and `pop` from the consumer thread.
+    """
+    def __init__(self, size):
+        """
+        Initializes a new SPSCRing
+
+        Parameters
+        ----------
+        size : int
+            Max number of items the queue can hold. Rounded up to a power of two so indexes can be
+            masked instead of using modulo
+        """
+        size = 1 << max(size - 1, 0).bit_length()
+        self._buffer = [None] * size
+        self._mask = size - 1
+        # Both indexes only ever increase, the slot is the index masked by the size
+        self._head = 0
+        self._tail = 0
+
+    def push(self, item):
+        """
+        Add an item to the queue. Only call from the producer thread
+
+        Parameters
+        ----------
+        item
+            Item to add to the queue. Must not be None
+
+        Returns
+        -------
+        bool
+            True if the item was added, False if the queue was full and the item was dropped
+        """
+        if self.full():
+            return False
+
+        tail = self._tail
+
+        self._buffer[tail & self._mask] = item
+        self._tail = tail + 1
+        return True
+
+    def full(self):
+        """
+        Check if the queue is full. Only call from the producer thread
+
+        Space can only be freed by the consumer so once this returns False the next `push` succeeds.
+
+        Returns
+        -------
+        bool
+            True if the queue is full, False otherwise
+        """
+        return self._tail - self._head > self._mask
+
+    def pop(self):
+        """
+        Remove the oldest item from the queue. Only call from the consumer thread
+
+        Returns
+        -------
+        any
+            The oldest item in the queue or None if the queue is empty
+        """
+        head = self._head
+        if head == self._tail:
+            return None
+
+        slot = head & self._mask
+        item = self._buffer[slot]
+        self._buffer[slot] = None
+        self._head = head + 1
+        return item
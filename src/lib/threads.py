@@ -0,0 +1,41 @@
+import ctypes
+import ctypes.util
+import os
+from sys import platform
+
+# From <sys/qos.h>
+_QOS_CLASS_USER_INTERACTIVE = 0x21
+
+def pin_current_thread(core):
+    """
+    Restrict the calling thread to a single CPU core
+
+    Only supported on Linux. Does nothing on other platforms or if core is None.
+
+    Parameters
+    ----------
+    core : int or None
+        Index of the core to run the thread on
+    """
+    if core is None or not hasattr(os, "sched_setaffinity"):
+        return
+
+    # On Linux pid 0 refers to the calling thread, not the whole process
+    os.sched_setaffinity(0, {core})
+
+def raise_current_thread_priority():
+    """
+    Ask the OS to schedule the calling thread ahead of ordinary threads
+
+    On Linux the thread's nice value is lowered, which requires CAP_SYS_NICE and is skipped without it.
+    On macOS the thread's QoS class is set to user interactive. A best effort that never raises.
+    """
+    if platform.startswith("linux"):
+        try:
+            # nice() only applies to the calling thread on Linux
+            os.nice(-5)
+        except PermissionError:
+            pass
+    elif platform == "darwin":
+        libc = ctypes.CDLL(ctypes.util.find_library("c"))
+        libc.pthread_set_qos_class_self_np(_QOS_CLASS_USER_INTERACTIVE, 0)
@@ -1,11 +1,21 @@
 import cv2
 import time
-from datetime import datetime
+import logging
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 
 from lib.clip import Clipper
 from lib.loudness import LoudnessDetector
 
 if __name__ == "__main__":
+    # Log records are handed off to a background thread so logging never blocks the capture or audio
+    # threads on writing to stdout
+    log_queue = SimpleQueue()
+    log_listener = QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+    log_listener.start()
+
     cap = cv2.VideoCapture(0)
     clipper = Clipper(cap, 2000)
 
@@ -13,12 +23,18 @@ if __name__ == "__main__":
 
     while True:
         try:
-            msg = loudness_detector.out_queue.get()
+            msg = loudness_detector.out_queue.pop()
+            if msg is None:
+                # Nothing detected yet. The clip is delayed by a second anyway so polling is plenty fast
+                time.sleep(0.01)
+                continue
+
             time.sleep(1)
-            clipper.clip(2000, "swing-" + datetime.now().strftime("%y-%m-%d-%H%M%S") + ".mp4")
+            clipper.clip(2000, f"swing-{time.strftime('%y-%m-%d-%H%M%S')}.mp4")
 
         except KeyboardInterrupt:
             clipper.stop()
             loudness_detector.stop()
             cv2.destroyAllWindows()
+            log_listener.stop()
             break
\ No newline at end of file